@@ -0,0 +1,189 @@
+# batch_match.py
+
+import os
+import time
+import logging
+from typing import Any, Optional
+
+from rules import Rule, Row, match_rule
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BATCH_MATCH = os.getenv("BATCH_MATCH", "0") == "1"
+BATCH_MIN_ROWS = int(os.getenv("BATCH_MIN_ROWS", "64"))
+# Rows per columnar chunk; NumPy string arrays are as wide as their longest value, so this bounds memory
+BATCH_PAGE_SIZE = int(os.getenv("BATCH_PAGE_SIZE", "1000"))
+
+if BATCH_MATCH and np is None:
+    logging.warning("BATCH_MATCH is set but numpy is not installed, using scalar matching")
+
+
+def is_plain_str(value: Any) -> bool:
+    """
+    True for strings that survive a round trip through a NumPy unicode array unchanged.
+    """
+    return isinstance(value, str) and not value.endswith("\x00")
+
+
+def is_vectorizable(rule: Rule) -> bool:
+    """
+    Checks that a rule can be evaluated with array operations.
+    Anything else is evaluated row by row with match_rule.
+    """
+    if not isinstance(rule, dict):
+        return False
+    if rule.get("type") == "pm":
+        return True
+    if rule.get("type") != "substring" or not is_plain_str(rule.get("match", "")):
+        return False
+    for cond_type in ("only_if", "not_if"):
+        conditions = rule.get(cond_type, {})
+        if not isinstance(conditions, dict):
+            return False
+        if not all(isinstance(key, str) and is_plain_str(val) for key, val in conditions.items()):
+            return False
+    return True
+
+
+class Columns:
+    """
+    Columnar view of a page of log rows, built lazily and shared by all rules.
+    """
+
+    def __init__(self, rows: list[Row]) -> None:
+        self.rows = rows
+        self._valid: dict[str, Any] = {}
+        self._columns: dict[tuple[str, bool], Any] = {}
+        self._contains: dict[tuple[str, str, bool], Any] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def valid(self, key: str) -> Any:
+        """
+        Rows where the field is a string, i.e. where match_rule cannot raise on it.
+        """
+        if key not in self._valid:
+            self._valid[key] = np.fromiter(
+                (is_plain_str(row.get(key, "")) for row in self.rows), dtype=bool, count=len(self.rows)
+            )
+        return self._valid[key]
+
+    def column(self, key: str, case_sensitive: bool) -> Any:
+        """
+        The field as a string array, lowercased unless case_sensitive. Invalid rows hold "".
+        """
+        if (key, case_sensitive) not in self._columns:
+            values = [row.get(key, "") for row in self.rows]
+            values = [v if is_plain_str(v) else "" for v in values]
+            if not case_sensitive:
+                values = [v.lower() for v in values]
+            self._columns[(key, case_sensitive)] = np.array(values, dtype=str)
+        return self._columns[(key, case_sensitive)]
+
+    def contains(self, key: str, term: str, case_sensitive: bool) -> Any:
+        """
+        Rows where term is a substring of the field; cached since many users share terms.
+        """
+        if (key, term, case_sensitive) not in self._contains:
+            self._contains[(key, term, case_sensitive)] = np.char.find(self.column(key, case_sensitive), term) >= 0
+        return self._contains[(key, term, case_sensitive)]
+
+
+def condition_mask(cols: Columns, key: str, val: str, case_sensitive: bool) -> Any:
+    """
+    Evaluates one only_if/not_if condition the way match_rule does.
+    """
+    val_cmp = val if case_sensitive else val.lower()
+    if key == "contains":
+        return cols.contains("message", val_cmp, case_sensitive)
+    return cols.column(key, case_sensitive) == val_cmp
+
+
+def rule_mask(rule: Rule, cols: Columns) -> Any:
+    """
+    Evaluates a vectorizable rule over every row of the page.
+    Rows with non-string fields are handed to match_rule so results stay identical.
+    """
+    if rule["type"] == "pm":
+        ok = cols.valid("window") & cols.valid("nick")
+        window = cols.column("window", True)
+        result = (window == cols.column("nick", True)) & ~np.char.startswith(window, "#")
+    else:
+        case_sensitive = bool(rule.get("case_sensitive", False))
+        match_val = rule.get("match", "")
+        match_cmp = match_val if case_sensitive else match_val.lower()
+        not_if = rule.get("not_if", {})
+        only_if = rule.get("only_if", {})
+
+        ok = cols.valid("message") & cols.valid("nick")
+        for key in list(not_if) + list(only_if):
+            if key != "contains":
+                ok = ok & cols.valid(key)
+
+        result = cols.contains("message", match_cmp, case_sensitive) & ~cols.contains("nick", match_cmp, case_sensitive)
+        if not_if:
+            suppress = np.ones(len(cols), dtype=bool)
+            for key, val in not_if.items():
+                suppress = suppress & condition_mask(cols, key, val, case_sensitive)
+            result = result & ~suppress
+        for key, val in only_if.items():
+            result = result & condition_mask(cols, key, val, case_sensitive)
+
+    result = result & ok
+    for i in np.flatnonzero(~ok):
+        result[i] = match_rule(rule, cols.rows[i])
+    return result
+
+
+def match_matrix(rows: list[Row], user_rules: dict[str, list[Rule]], stats: Any = None) -> tuple[list[str], Any]:
+    """
+    Builds a (row, recipient) boolean match matrix for a page of rows.
+    Rows that parse_log would skip never match. Costs are recorded in stats (a RuleStats) if given.
+    """
+    recipients = list(user_rules)
+    matrix = np.zeros((len(rows), len(recipients)), dtype=bool)
+    eligible = [i for i, row in enumerate(rows) if row["type"] in ["msg", "action"]]
+    cols = Columns([rows[i] for i in eligible])
+
+    for j, recipient in enumerate(recipients):
+        user_mask = np.zeros(len(cols), dtype=bool)
+        user_elapsed = 0.0
+        for index, rule in enumerate(user_rules[recipient]):
+            start = time.perf_counter()
+            if is_vectorizable(rule):
+                mask = rule_mask(rule, cols)
+            else:
+                mask = np.fromiter((match_rule(rule, row) for row in cols.rows), dtype=bool, count=len(cols))
+            elapsed = time.perf_counter() - start
+            user_elapsed += elapsed
+            user_mask |= mask
+            if stats is not None:
+                stats.record(recipient, index, rule, elapsed, int(mask.sum()), count=len(cols))
+        if stats is not None:
+            stats.record_message(recipient, user_elapsed, int(user_mask.sum()), count=len(cols))
+        matrix[eligible, j] = user_mask
+
+    return recipients, matrix
+
+
+def match_batch(rows: list[Row], user_rules: dict[str, list[Rule]], stats: Any = None) -> Optional[list[list[str]]]:
+    """
+    Returns the matching recipients for each row, or None when the scalar path should be used:
+    batch matching disabled, numpy missing, or a page smaller than BATCH_MIN_ROWS.
+    Rows are matched in chunks of BATCH_PAGE_SIZE so a large backlog does not build huge arrays.
+    """
+    if not BATCH_MATCH or np is None or len(rows) < BATCH_MIN_ROWS:
+        return None
+    start = time.perf_counter()
+    matches: list[list[str]] = []
+    size = max(BATCH_PAGE_SIZE, 1)
+    for offset in range(0, len(rows), size):
+        recipients, matrix = match_matrix(rows[offset:offset + size], user_rules, stats)
+        matches.extend([recipients[j] for j in np.flatnonzero(row)] for row in matrix)
+    logging.debug(f"Batch matched {len(rows)} rows against {len(user_rules)} users "
+                  f"in {1000 * (time.perf_counter() - start):.1f} ms")
+    return matches
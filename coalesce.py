@@ -0,0 +1,140 @@
+# coalesce.py
+
+import os
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+Row = dict[str, Any]
+
+# Seconds to hold matches for a recipient before writing them as one push; 0 writes immediately
+PUSH_COALESCE_WINDOW = float(os.getenv("PUSH_COALESCE_WINDOW", "0"))
+# Sustained pushes per second allowed per recipient; 0 disables rate limiting
+PUSH_RATE = float(os.getenv("PUSH_RATE", "0"))
+# Pushes a recipient may receive back to back before PUSH_RATE applies
+PUSH_BURST = float(os.getenv("PUSH_BURST", "5"))
+# Lines quoted in the message of a digest push
+PUSH_DIGEST_SAMPLES = int(os.getenv("PUSH_DIGEST_SAMPLES", "3"))
+
+
+@dataclass
+class TokenBucket:
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
+
+    def take(self, now: float) -> bool:
+        """
+        Consumes one token if available.
+        """
+        if self.rate <= 0:
+            return True
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+@dataclass
+class Pending:
+    first: Row
+    last: Row
+    since: float
+    count: int = 1
+    samples: list[Row] = field(default_factory=list)
+
+
+def format_line(row: Row) -> str:
+    return f"[{row['window']}] <{row['nick']}> {row['message']}"
+
+
+class PushCoalescer:
+    """
+    Folds a recipient's matches within a window into a single push row and caps pushes per recipient.
+    Matches held back by the rate limit keep accumulating into the next digest, so nothing is dropped.
+    """
+
+    def __init__(self, window: float = PUSH_COALESCE_WINDOW, rate: float = PUSH_RATE,
+                 burst: float = PUSH_BURST, samples: int = PUSH_DIGEST_SAMPLES) -> None:
+        self.window = window
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.samples = samples
+        self.pending: dict[str, Pending] = {}
+        self.buckets: dict[str, TokenBucket] = {}
+
+    def add(self, recipient: str, row: Row, now: Optional[float] = None) -> list[Row]:
+        """
+        Adds a matched push row and returns any push rows for this recipient that are ready to write.
+        """
+        now = time.monotonic() if now is None else now
+        pending = self.pending.get(recipient)
+        if pending is None:
+            self.pending[recipient] = Pending(first=row, last=row, since=now, samples=[row])
+        else:
+            pending.last = row
+            pending.count += 1
+            if len(pending.samples) < self.samples:
+                pending.samples.append(row)
+        ready = self._release(recipient, now)
+        return [ready] if ready else []
+
+    def due(self, now: Optional[float] = None) -> list[Row]:
+        """
+        Returns push rows for every recipient whose window has elapsed and who has a token.
+        """
+        now = time.monotonic() if now is None else now
+        ready = [self._release(recipient, now) for recipient in list(self.pending)]
+        return [row for row in ready if row]
+
+    def drain(self) -> list[Row]:
+        """
+        Returns push rows for every pending recipient, ignoring the window and the rate limit.
+        Used on shutdown so held matches are not lost.
+        """
+        ready = [self.digest(pending) for pending in self.pending.values()]
+        self.pending.clear()
+        return ready
+
+    def _release(self, recipient: str, now: float) -> Optional[Row]:
+        pending = self.pending[recipient]
+        if now - pending.since < self.window:
+            return None
+        bucket = self.buckets.get(recipient)
+        if bucket is None:
+            bucket = self.buckets[recipient] = TokenBucket(self.rate, self.burst, self.burst, now)
+        if not bucket.take(now):
+            return None
+        del self.pending[recipient]
+        return self.digest(pending)
+
+    def digest(self, pending: Pending) -> Row:
+        """
+        Builds the push row for a set of coalesced matches. A single match is passed through unchanged.
+        """
+        if pending.count == 1:
+            return pending.first
+        last = pending.last
+        lines = [format_line(row) for row in pending.samples]
+        if pending.count > len(lines):
+            lines.append(f"... and {pending.count - len(lines)} more")
+        logging.debug(f"Coalesced {pending.count} matches for {last['recipient']} "
+                      f"({pending.first['id']}..{last['id']})")
+        # push is keyed by (id, recipient), so other recipients of the same line do not collide
+        return {
+            "id": last["id"],
+            "user": last["user"],
+            "network": last["network"],
+            "window": last["window"],
+            "type": "digest",
+            "nick": last["nick"],
+            "message": "\n".join(lines),
+            "recipient": last["recipient"],
+            "match_count": pending.count,
+            "first_id": pending.first["id"],
+            "last_id": last["id"]
+        }
@@ -0,0 +1,212 @@
+# leases.py
+
+import os
+import math
+import time
+import zlib
+import socket
+import logging
+from typing import Optional
+
+from psconnect import Connection
+
+# Number of network hash partitions of logs_queue; 0 runs a single node without leases
+PARTITIONS = int(os.getenv("PARTITIONS", "0"))
+# Seconds a lease stays valid without a heartbeat
+LEASE_TTL = float(os.getenv("LEASE_TTL", "15"))
+# Rows fetched per page in partitioned mode
+PARTITION_PAGE_SIZE = int(os.getenv("PARTITION_PAGE_SIZE", "500"))
+NODE_ID = os.getenv("NODE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+QUEUE_LEASE = "queue"
+# Membership rows, one per live parser node, heartbeated like any other lease
+NODE_LEASE_PREFIX = "node:"
+
+
+def network_partition(network: Optional[str], partitions: int) -> int:
+    """
+    Partition of a log row, CRC32 of its network modulo the number of partitions.
+    """
+    return zlib.crc32((network or "").encode()) % partitions if partitions else 0
+
+
+def partition_lease(partition: int) -> str:
+    return f"parser:{partition}"
+
+
+def lease_partition(name: str) -> int:
+    return int(name.split(":", 1)[1])
+
+
+class LeaseManager:
+    """
+    Database-backed leases with expiry. Times come from the database clock so nodes need not agree.
+    Database errors are logged and treated as holding nothing, so a node backs off instead of exiting.
+    """
+
+    def __init__(self, conn: Connection, node_id: str = NODE_ID, ttl: float = LEASE_TTL) -> None:
+        self.conn = conn
+        self.node_id = node_id
+        self.ttl = ttl
+        self.ttl_us = int(ttl * 1_000_000)
+        self.node_lease = f"{NODE_LEASE_PREFIX}{node_id}"
+        self.last_renewed = 0.0
+
+    def ensure(self, names: list[str]) -> None:
+        """
+        Creates lease rows that do not exist yet.
+        """
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.executemany("INSERT IGNORE INTO leases (name) VALUES (%s)", [(name,) for name in names])
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logging.error(f"Failed to create leases {names}: {e}")
+
+    def renew(self, names: list[str]) -> set[str]:
+        """
+        Extends this node's unexpired leases among names and returns the ones it still holds.
+        A lease that already expired is lost, since another node may have taken it over.
+        """
+        placeholders = ", ".join(["%s"] * len(names))
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute(
+                    f"UPDATE leases SET expires_at = NOW(3) + INTERVAL %s MICROSECOND, heartbeat_at = NOW(3) "
+                    f"WHERE owner = %s AND expires_at > NOW(3) AND name IN ({placeholders})",
+                    (self.ttl_us, self.node_id, *names)
+                )
+                cursor.execute(
+                    f"SELECT name FROM leases WHERE owner = %s AND expires_at > NOW(3) AND name IN ({placeholders})",
+                    (self.node_id, *names)
+                )
+                owned = {row["name"] for row in cursor.fetchall()}
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logging.error(f"Failed to renew leases for {self.node_id}: {e}")
+            return set()
+        self.last_renewed = time.monotonic()
+        return owned
+
+    def heartbeat(self, names: list[str]) -> set[str]:
+        """
+        Renews this node's membership row along with its leases among names.
+        Returns the leases among names that are still held.
+        """
+        return self.renew(names + [self.node_lease]) & set(names)
+
+    def renew_due(self) -> bool:
+        """
+        True once a third of the TTL has passed since the last renewal.
+        """
+        return time.monotonic() - self.last_renewed >= self.ttl / 3
+
+    def claim(self, names: list[str], limit: int) -> set[str]:
+        """
+        Takes up to `limit` free or expired leases among names. Rows locked by another claimer are skipped.
+        """
+        if limit <= 0:
+            return set()
+        placeholders = ", ".join(["%s"] * len(names))
+        try:
+            self.conn.begin()
+            with self.conn.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT name FROM leases WHERE name IN ({placeholders}) "
+                    f"AND (owner IS NULL OR expires_at IS NULL OR expires_at <= NOW(3)) "
+                    f"ORDER BY name LIMIT %s FOR UPDATE SKIP LOCKED",
+                    (*names, limit)
+                )
+                claimed = [row["name"] for row in cursor.fetchall()]
+                if claimed:
+                    cursor.execute(
+                        f"UPDATE leases SET owner = %s, expires_at = NOW(3) + INTERVAL %s MICROSECOND, "
+                        f"heartbeat_at = NOW(3) WHERE name IN ({', '.join(['%s'] * len(claimed))})",
+                        (self.node_id, self.ttl_us, *claimed)
+                    )
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logging.error(f"Failed to claim leases for {self.node_id}: {e}")
+            return set()
+        if claimed:
+            logging.info(f"{self.node_id} claimed leases: {claimed}")
+        return set(claimed)
+
+    def release(self, names: set[str]) -> bool:
+        """
+        Gives up leases held by this node so other nodes can claim them immediately.
+        Returns False if the release failed, in which case the leases are still held.
+        """
+        if not names:
+            return True
+        placeholders = ", ".join(["%s"] * len(names))
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute(
+                    f"UPDATE leases SET owner = NULL, expires_at = NULL WHERE owner = %s AND name IN ({placeholders})",
+                    (self.node_id, *names)
+                )
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logging.error(f"Failed to release leases {sorted(names)} for {self.node_id}: {e}")
+            return False
+        logging.info(f"{self.node_id} released leases: {sorted(names)}")
+        return True
+
+    def live_nodes(self) -> Optional[int]:
+        """
+        Counts parser nodes with an unexpired membership row, and removes the rows of dead nodes.
+        Returns None if the count could not be read.
+        """
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM leases WHERE name LIKE %s AND name != %s AND (expires_at IS NULL OR expires_at <= NOW(3))",
+                    (f"{NODE_LEASE_PREFIX}%", self.node_lease)
+                )
+                cursor.execute(
+                    "SELECT COUNT(*) AS nodes FROM leases WHERE name LIKE %s AND expires_at > NOW(3)",
+                    (f"{NODE_LEASE_PREFIX}%",)
+                )
+                nodes = cursor.fetchone()["nodes"]
+            self.conn.commit()
+            return nodes
+        except Exception as e:
+            self.conn.rollback()
+            logging.error(f"Failed to count live nodes: {e}")
+            return None
+
+    def hold(self, name: str) -> bool:
+        """
+        Keeps or acquires a single exclusive lease, e.g. for a leader-only task.
+        """
+        return name in self.renew([name]) or name in self.claim([name], 1)
+
+    def balance(self, names: list[str]) -> set[str]:
+        """
+        Heartbeats this node's membership row, renews its leases among names, and claims or
+        releases leases so that every live node holds roughly an equal share.
+        Returns the leases held afterwards.
+        """
+        owned = self.renew(names + [self.node_lease])
+        if self.node_lease not in owned:
+            self.ensure([self.node_lease])
+            if not self.claim([self.node_lease], 1):
+                # Without membership other nodes would not leave room for us; keep what we hold
+                return owned & set(names)
+        owned &= set(names)
+        nodes = self.live_nodes()
+        if not nodes:
+            return owned
+        target = math.ceil(len(names) / nodes)
+        if len(owned) > target:
+            extra = set(sorted(owned)[target:])
+            if self.release(extra):
+                owned -= extra
+        elif len(owned) < target:
+            owned |= self.claim(names, target - len(owned))
+        return owned
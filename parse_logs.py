@@ -4,7 +4,9 @@
 from psconnect import (
     get_db_connection,
     insert_into,
+    insert_many,
     select_from,
+    select_partitions,
     delete_from,
     Connection,
     Row,
@@ -12,17 +14,28 @@ from psconnect import (
 )
 from zlog_queue import get_last_processed_id
 from rules import match_rule, fetch_rules, validate_rules
+from profiler import install_profiler
+from rule_stats import RuleStats
+from batch_match import match_batch
+from coalesce import PushCoalescer
+from leases import LeaseManager, PARTITIONS, PARTITION_PAGE_SIZE, partition_lease, lease_partition
 
 import json
 import time
+import signal
 import logging
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
+from typing import Optional
 
 # Global shared state
 conn: Connection
 users: list[str]
 user_rules: dict[str, list[dict]]
+rule_stats = RuleStats()
+coalescer = PushCoalescer()
+pending_events: list[Row] = []
+stop_requested = False
 
 
 def serialize_log_safe(log: dict) -> str:
@@ -45,40 +58,108 @@ def setup_logging() -> None:
     logger.addHandler(debug_handler)
 
 
-def parse_log(log: Row) -> None:
-    if log["type"] not in ["msg", "action"]:
-        logging.debug(f"Skipping log {log['id']} due to unsupported type: {log['type']}")
-        return
-
-    matched_any = False
-
+def match_recipients(log: Row) -> list[str]:
+    """
+    Evaluates every user's rules against a log and returns the users with a matching rule.
+    """
+    recipients = []
     for recipient, rules in user_rules.items():
-        for rule in rules:
+        user_elapsed = 0.0
+        user_matched = False
+        for index, rule in enumerate(rules):
             logging.debug(f"Evaluating rule for {recipient} on log {log['id']}: {json.dumps(rule)}")
-            if match_rule(rule, log):
+            start = time.perf_counter()
+            matched = match_rule(rule, log)
+            elapsed = time.perf_counter() - start
+            rule_stats.record(recipient, index, rule, elapsed, matched)
+            user_elapsed += elapsed
+            if matched:
                 logging.debug(f"Rule matched for user {recipient} on log {log['id']}")
-                matched_any = True
-                row = {
-                    "id": log["id"],
-                    "user": log["user"],
-                    "network": log["network"],
-                    "window": log["window"],
-                    "type": log["type"],
-                    "nick": log["nick"],
-                    "message": log["message"],
-                    "recipient": recipient
-                }
-                try:
-                    insert_into(conn, row, 'push')
-                except Exception as e:
-                    logging.error("Failed to insert log %s into push: %s", log["id"], e)
+                user_matched = True
+        rule_stats.record_message(recipient, user_elapsed, user_matched)
+        if user_matched:
+            recipients.append(recipient)
+    return recipients
+
+
+def write_push(row: Row) -> None:
+    try:
+        insert_into(conn, row, 'push')
+    except Exception as e:
+        logging.error("Failed to insert log %s into push: %s", row["id"], e)
+
+
+def write_match(log: Row, recipient: str) -> None:
+    """
+    Queues a matched log for event_log and hands it to the coalescer for push.
+    """
+    row = {
+        "id": log["id"],
+        "user": log["user"],
+        "network": log["network"],
+        "window": log["window"],
+        "type": log["type"],
+        "nick": log["nick"],
+        "message": log["message"],
+        "recipient": recipient
+    }
+    pending_events.append(row)
+    for push_row in coalescer.add(recipient, row):
+        write_push(push_row)
+
+
+def flush_writes() -> None:
+    """
+    Writes queued event_log rows in bulk and any coalesced pushes that are due.
+    """
+    if pending_events:
+        # event_log is keyed by id alone, so a line matching several users keeps its first row
+        events: dict[int, Row] = {}
+        for row in pending_events:
+            if row["id"] in events:
+                logging.debug("Duplicate entry: %s", row["id"])
+            else:
+                events[row["id"]] = row
+        try:
+            insert_many(conn, list(events.values()), 'event_log', ignore=True)
+        except Exception as e:
+            logging.debug("Bulk insert into event_log failed, inserting rows one by one: %s", e)
+            for row in events.values():
                 try:
                     insert_into(conn, row, 'event_log')
                 except Exception as e:
-                    logging.error("Failed to insert log %s into event_log: %s", log["id"], e)
+                    logging.error("Failed to insert log %s into event_log: %s", row["id"], e)
                     if "Duplicate entry" in str(e):
-                        logging.debug("Duplicate entry: %s", log["id"])
-    if not matched_any:
+                        logging.debug("Duplicate entry: %s", row["id"])
+        pending_events.clear()
+    for push_row in coalescer.due():
+        write_push(push_row)
+
+
+def drain_writes() -> None:
+    """
+    Writes pending event_log rows and every push still held by the coalescer, for shutdown.
+    """
+    flush_writes()
+    for push_row in coalescer.drain():
+        write_push(push_row)
+
+
+def parse_log(log: Row, recipients: Optional[list[str]] = None) -> None:
+    """
+    Writes a log to push and event_log for each matching user.
+    recipients comes from match_batch when the page was batch matched, otherwise rules are evaluated here.
+    """
+    if log["type"] not in ["msg", "action"]:
+        logging.debug(f"Skipping log {log['id']} due to unsupported type: {log['type']}")
+        return
+
+    if recipients is None:
+        recipients = match_recipients(log)
+
+    for recipient in recipients:
+        write_match(log, recipient)
+    if not recipients:
         logging.debug("No rule matched for log %s", serialize_log_safe(log))
 
 
@@ -104,8 +185,21 @@ def maybe_track_pm(log: Row, pm_cache: set[tuple[str, str]]) -> None:
                 logging.error("Failed to insert log %s into pm_table: %s", log["id"], e)
 
 
+def request_stop(*_args) -> None:
+    """
+    SIGTERM handler. Only sets a flag, so a database call in progress is never interrupted;
+    the main loop stops at the next row and main's finally writes held pushes.
+    """
+    global stop_requested
+    stop_requested = True
+    logging.info("Stop requested, finishing the current page")
+
+
 def main() -> None:
     setup_logging()
+    install_profiler("parse_logs")
+    signal.signal(signal.SIGTERM, request_stop)
+    leases: Optional[LeaseManager] = None
     try:
         global conn, users, user_rules
         conn = get_db_connection()
@@ -127,22 +221,63 @@ def main() -> None:
                 user_rules[user] = rules
             else:
                 logging.warning(f"Rules for {user} failed validation")
+        rule_stats.prune(conn, user_rules)
+        # In partitioned mode each owned partition keeps its own cursor; a newly claimed
+        # partition starts from the beginning of the queue to pick up a dead node's rows
+        lease_names = [partition_lease(p) for p in range(PARTITIONS)]
+        partition_bases: dict[int, int] = {}
+        if PARTITIONS:
+            leases = LeaseManager(conn)
+            leases.ensure(lease_names)
+
         count: int = 0
-        while True:
-            logs = select_from(conn, "logs_queue", last_processed_id, desc=False)
+        while not stop_requested:
+            if leases is not None:
+                owned = {lease_partition(name) for name in leases.balance(lease_names)}
+                partition_bases = {p: partition_bases.get(p, 0) for p in owned}
+                logs = select_partitions(conn, "logs_queue", partition_bases, PARTITION_PAGE_SIZE)
+            else:
+                logs = select_from(conn, "logs_queue", last_processed_id, desc=False)
+            # The partition column is queue bookkeeping, not part of the log row
+            log_partitions = {log["id"]: log.pop("partition", 0) for log in logs or []}
             if not logs:
+                flush_writes()
                 time.sleep(1)
                 continue
 
-            for log in logs:
-                parse_log(log)
+            batch = match_batch(logs, user_rules, rule_stats)
+            processed: list[Row] = []
+            for i, log in enumerate(logs):
+                if stop_requested:
+                    break
+                if leases is not None:
+                    # Heartbeat during long pages, and leave rows of partitions we lost to their new owner
+                    if leases.renew_due():
+                        still_held = {lease_partition(name) for name in leases.heartbeat(lease_names)}
+                        if owned - still_held:
+                            logging.warning(f"Lost partitions {sorted(owned - still_held)} mid-page, skipping their rows")
+                        owned &= still_held
+                    if log_partitions[log["id"]] not in owned:
+                        continue
+                parse_log(log, batch[i] if batch is not None else None)
                 maybe_track_pm(log, pm_cache)
+                processed.append(log)
+            if leases is not None and leases.renew_due():
+                leases.heartbeat(lease_names)
+            flush_writes()
+            for log in processed:
+                # Rows already written are deleted even if their partition moved, so the new owner does not repeat them
+                if leases is not None and leases.renew_due():
+                    leases.heartbeat(lease_names)
                 try:
                     delete_from(conn, 'logs_queue', {"id": log["id"]})
                 except Exception as e:
                     logging.error("Failed to delete log %s from logs_queue: %s", log["id"], e)
                 print(f"Processed log {log['id']}")
                 last_processed_id = log["id"]
+                if leases is not None:
+                    partition_bases[log_partitions[log["id"]]] = log["id"]
+            rule_stats.maybe_flush(conn)
             if count % 100 == 99:
                 logging.debug(f"Processed {count + 1} logs, updating users and rules")
                 users = fetch_users(conn)
@@ -156,11 +291,20 @@ def main() -> None:
                         user_rules[user] = rules
                     else:
                         logging.warning(f"Rules for {user} failed validation")
+                rule_stats.prune(conn, user_rules)
             count += 1
 
     except Exception as e:
         logging.error("An error occurred: %s", e)
         print(f"An error occurred: {e}")
+    finally:
+        try:
+            drain_writes()
+        except Exception as e:
+            logging.error("Failed to write held pushes on shutdown: %s", e)
+        if leases is not None:
+            # Hand partitions over right away instead of making other nodes wait for LEASE_TTL
+            leases.release(set(lease_names) | {leases.node_lease})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,231 @@
+# profiler.py
+
+import os
+import sys
+import signal
+import logging
+import threading
+import time
+from collections import Counter
+from html import escape
+from types import FrameType
+from typing import Optional
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+# Innermost frame wins, so logging done inside match_rule is booked as logging
+CATEGORIES = ("rules", "db", "logging", "json", "other")
+
+
+def frame_label(frame: FrameType) -> str:
+    """
+    Returns a 'module:function' label for a stack frame.
+    """
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{frame.f_code.co_name}"
+
+
+def classify_frame(frame: FrameType) -> Optional[str]:
+    """
+    Maps a single stack frame to a cost category, or None if it is not one we track.
+    """
+    module = frame.f_globals.get("__name__", "")
+    top = module.split(".")[0]
+    if top == "logging":
+        return "logging"
+    if top == "json":
+        return "json"
+    if top in ("psconnect", "pymysql"):
+        return "db"
+    if top == "rules" and frame.f_code.co_name == "match_rule":
+        return "rules"
+    return None
+
+
+def render_flamegraph(stacks: Counter, title: str, width: int = 1200) -> str:
+    """
+    Renders collapsed stacks into a minimal standalone flame graph SVG.
+    """
+    tree: dict = {}
+    for stack, count in stacks.items():
+        node = tree
+        for part in stack.split(";"):
+            entry = node.setdefault(part, [0, {}])
+            entry[0] += count
+            node = entry[1]
+
+    total = sum(stacks.values()) or 1
+    row_height = 16
+    rects: list[tuple[float, int, float, str, int]] = []
+    max_depth = 0
+
+    def walk(node: dict, x: float, depth: int) -> None:
+        nonlocal max_depth
+        max_depth = max(max_depth, depth)
+        for name, (count, children) in sorted(node.items()):
+            w = width * count / total
+            if w >= 0.5:
+                rects.append((x, depth, w, name, count))
+                walk(children, x, depth + 1)
+            x += w
+
+    walk(tree, 0.0, 0)
+    height = (max_depth + 2) * row_height + 24
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+        f'<text x="4" y="14">{escape(title)} ({total} samples)</text>',
+    ]
+    for x, depth, w, name, count in rects:
+        y = height - (depth + 1) * row_height
+        hue = 20 + (sum(map(ord, name)) % 40)
+        label = escape(name) if w > 40 else ""
+        out.append(
+            f'<g><title>{escape(name)} ({count} samples, {100 * count / total:.1f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row_height - 1}" fill="hsl({hue},90%,60%)"/>'
+            f'<text x="{x + 2:.1f}" y="{y + 12}">{label[:int(w / 7)]}</text></g>'
+        )
+    out.append("</svg>")
+    return "\n".join(out)
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler for the main thread of a daemon.
+    Nothing runs until it is started, so an idle profiler costs nothing.
+    """
+
+    def __init__(self, name: str, interval: float = PROFILE_INTERVAL, out_dir: str = PROFILE_DIR) -> None:
+        self.name = name
+        self.interval = interval
+        self.out_dir = out_dir
+        self.target = threading.main_thread().ident
+        self.stacks: Counter = Counter()
+        self.categories: Counter = Counter()
+        self.started_at = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Reentrant because the signal handler may interrupt the main thread inside start()
+        self._lock = threading.RLock()
+        self._restart = False
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        """
+        Starts a sampling window in a background thread.
+        """
+        with self._lock:
+            if self.running:
+                return
+            self._reset()
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-profiler", daemon=True)
+            self._thread.start()
+
+    def _reset(self) -> None:
+        self.stacks = Counter()
+        self.categories = Counter()
+        self.started_at = time.time()
+        self._stop.clear()
+
+    def stop(self) -> None:
+        """
+        Ends the current sampling window; the sampler thread writes the output on exit.
+        """
+        self._stop.set()
+
+    def toggle(self, *_args) -> None:
+        """
+        Signal handler entry point: starts the profiler if idle, stops it otherwise.
+        A signal that arrives while the previous window is still being written starts a new
+        window once the write finishes.
+        """
+        with self._lock:
+            if not self.running:
+                self.start()
+            elif not self._stop.is_set():
+                self.stop()
+            else:
+                self._restart = True
+                logging.info(f"Profiler for {self.name} is still writing, restarting once done")
+
+    def sample(self, frame: FrameType) -> None:
+        """
+        Records one stack sample, outermost frame first.
+        """
+        labels = []
+        category = None
+        while frame is not None:
+            labels.append(frame_label(frame))
+            if category is None:
+                category = classify_frame(frame)
+            frame = frame.f_back
+        labels.reverse()
+        self.stacks[";".join(labels)] += 1
+        self.categories[category or "other"] += 1
+
+    def _run(self) -> None:
+        while True:
+            logging.info(f"Profiler started for {self.name} (interval {self.interval}s)")
+            while not self._stop.wait(self.interval):
+                frame = sys._current_frames().get(self.target)
+                if frame is not None:
+                    self.sample(frame)
+            try:
+                self.write()
+            except Exception as e:
+                logging.error(f"Failed to write profile for {self.name}: {e}")
+            with self._lock:
+                if not self._restart:
+                    self._thread = None
+                    return
+                self._restart = False
+                self._reset()
+
+    def summary(self) -> str:
+        """
+        Returns a per-category breakdown of the collected samples.
+        """
+        total = sum(self.categories.values()) or 1
+        lines = [f"{self.name}: {sum(self.categories.values())} samples over {time.time() - self.started_at:.1f}s"]
+        for category in CATEGORIES:
+            count = self.categories.get(category, 0)
+            lines.append(f"  {category:<8} {count:>8} {100 * count / total:6.1f}%")
+        return "\n".join(lines)
+
+    def write(self) -> str:
+        """
+        Writes collapsed stacks, a flame graph and the category summary for the window.
+        Returns the common path prefix of the written files.
+        """
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+        prefix = os.path.join(self.out_dir, f"{self.name}-{os.getpid()}-{stamp}")
+
+        with open(f"{prefix}.folded", "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(f"{prefix}.svg", "w") as f:
+            f.write(render_flamegraph(self.stacks, f"{self.name} {stamp}"))
+        summary = self.summary()
+        with open(f"{prefix}.txt", "w") as f:
+            f.write(summary + "\n")
+
+        logging.info(f"Profile written to {prefix}.*\n{summary}")
+        return prefix
+
+
+def install_profiler(name: str) -> Optional[SamplingProfiler]:
+    """
+    Installs a SIGUSR1 handler that toggles a sampling profiler for this process.
+    Returns None on platforms without SIGUSR1.
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        logging.debug("SIGUSR1 not available, profiler not installed")
+        return None
+    profiler = SamplingProfiler(name)
+    signal.signal(signal.SIGUSR1, profiler.toggle)
+    logging.debug(f"Profiler installed for {name}, send SIGUSR1 to pid {os.getpid()} to toggle")
+    return profiler
@@ -48,7 +48,8 @@ table_schemas = {
             {"window": [str, False]},
             {"type": [str, False]},
             {"nick": [str, True]},
-            {"message": [str, True]}
+            {"message": [str, True]},
+            {"partition": [int, True]}
         ]
     },
     "event_log":     {
@@ -76,7 +77,10 @@ table_schemas = {
             {"nick": [str, True]},
             {"type": [str, False]},
             {"user": [str, True]},
-            {"window": [str, False]}
+            {"window": [str, False]},
+            {"match_count": [int, True]},
+            {"first_id": [int, True]},
+            {"last_id": [int, True]}
         ]
     },
     "users":         {
@@ -88,6 +92,21 @@ table_schemas = {
             {"telegram_chat_id": [int, True]},
             {"hotwords": [list[dict], True]}
         ]
+    },
+    "rule_stats":    {
+        "meta-schema": {
+            "column": ["type", "nullable"]
+        },
+        "columns":     [
+            {"user": [str, False]},
+            {"rule_index": [int, False]},
+            {"rule": [str, True]},
+            {"evaluations": [int, False]},
+            {"matches": [int, False]},
+            {"total_ms": [float, False]},
+            {"avg_ms": [float, False]},
+            {"over_budget": [int, False]}
+        ]
     }
 }
 
@@ -101,17 +120,20 @@ def get_db_connection() -> Connection:
     Establishes a connection to the database using environment variables for configuration.
     Returns a pymysql.Connection object.
     """
+    # An empty DB_SSL_CA disables TLS, e.g. for a local test database
+    ssl_ca = os.getenv("DB_SSL_CA", "/etc/ssl/cert.pem")
+    ssl_options = {"ssl": {"ca": ssl_ca}, "ssl_verify_identity": True} if ssl_ca else {}
     try:
         # Connect to the database using environment variables
         conn = pymysql.connect(
             host=os.getenv("DB_HOST"),
+            port=int(os.getenv("DB_PORT", "3306")),
             user=os.getenv("DB_USERNAME"),
             password=os.getenv("DB_PASSWORD"),
             db=os.getenv("DB_NAME"),
             autocommit=True,
-            ssl={"ca": "/etc/ssl/cert.pem"},
-            ssl_verify_identity=True,
-            cursorclass=pymysql.cursors.DictCursor
+            cursorclass=pymysql.cursors.DictCursor,
+            **ssl_options
         )
         return conn
     except pymysql.MySQLError as e:
@@ -188,6 +210,31 @@ def insert_into(conn: pymysql.Connection, row: Row, table: str) -> None:
         raise e
 
 
+def insert_many(conn: pymysql.Connection, rows: list[Row], table: str, ignore: bool = False) -> None:
+    """
+    Inserts several rows with the same columns into a specified table in one statement.
+    Validates every row against the table schema before insertion.
+    With ignore, rows that collide with an existing key are skipped instead of failing the statement.
+    """
+    if not rows:
+        return
+    if not all(validate_schema(row, table) for row in rows):
+        raise ValueError("Invalid schema")
+    cols = ', '.join(f'`{col}`' for col in rows[0].keys())
+    vals = ', '.join(f'%({col})s' for col in rows[0].keys())
+    sql = f'INSERT {"IGNORE " if ignore else ""}INTO `{table}` ({cols}) VALUES ({vals})'
+    try:
+        # Execute the insert statement for all rows
+        with conn.cursor() as cursor:
+            cursor.executemany(sql, rows)
+            conn.commit()
+    except pymysql.MySQLError as e:
+        # Rollback the transaction in case of an error
+        conn.rollback()
+        logging.error(f"Error inserting {len(rows)} rows into {table}: {e}")
+        raise e
+
+
 def replace_into(conn: pymysql.Connection, row: Row, table: str) -> None:
     """
     Replaces a row in a specified table in the database.
@@ -209,22 +256,65 @@ def replace_into(conn: pymysql.Connection, row: Row, table: str) -> None:
         logging.error(f"Error replacing into {table}: {e}")
 
 
-def select_from(conn: pymysql.Connection, table: str, base: int = 28000000, desc: bool = False) -> Optional[list[dict]]:
+def select_from(conn: pymysql.Connection, table: str, base: int = 28000000, desc: bool = False,
+                limit: Optional[int] = None) -> Optional[list[dict]]:
     """
     Selects rows from a specified table in the database where the id is greater than a base value.
+    With limit, at most that many rows are returned.
     Returns a list of dictionaries representing the selected rows.
     """
     try:
         # Execute the select statement
         cursor: Cursor | Any
         with conn.cursor() as cursor:
-            cursor.execute(f"SELECT * FROM {table} WHERE id > {base} ORDER BY id {'DESC' if desc else 'ASC'}")
+            cursor.execute(f"SELECT * FROM {table} WHERE id > {base} ORDER BY id {'DESC' if desc else 'ASC'}"
+                           + (f" LIMIT {int(limit)}" if limit is not None else ""))
             return cursor.fetchall()
     except pymysql.MySQLError as e:
         logging.error(f"Error selecting from {table}: {e}")
         return None
 
 
+def select_partitions(conn: pymysql.Connection, table: str, bases: dict[int, int],
+                      limit: int) -> Optional[list[dict]]:
+    """
+    Selects the first rows from a specified table whose `partition` column is one of the given
+    partitions, with ids above that partition's base. Each partition is read separately through the
+    (partition, id) index, so a page never scans or sorts more than `limit` rows per partition.
+    Returns a list of dictionaries representing the selected rows.
+    """
+    if not bases:
+        return []
+    parts = " UNION ALL ".join(
+        f"(SELECT * FROM `{table}` WHERE `partition` = %s AND id > %s ORDER BY id ASC LIMIT %s)" for _ in bases
+    )
+    params = [value for partition, base in bases.items() for value in (partition, base, limit)]
+    try:
+        cursor: Cursor | Any
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT * FROM ({parts}) AS page ORDER BY id ASC LIMIT %s", (*params, limit))
+            return cursor.fetchall()
+    except pymysql.MySQLError as e:
+        logging.error(f"Error selecting partitions from {table}: {e}")
+        return None
+
+
+def select_recent(conn: pymysql.Connection, table: str, limit: int) -> Optional[list[dict]]:
+    """
+    Selects the most recent rows from a specified table, oldest first.
+    Returns a list of dictionaries representing the selected rows.
+    """
+    try:
+        cursor: Cursor | Any
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT * FROM (SELECT * FROM `{table}` ORDER BY id DESC LIMIT %s) AS recent ORDER BY id ASC",
+                           (limit,))
+            return cursor.fetchall()
+    except pymysql.MySQLError as e:
+        logging.error(f"Error selecting recent rows from {table}: {e}")
+        return None
+
+
 def delete_from(conn: pymysql.Connection, table: str, conditions: dict) -> None:
     """
     Deletes rows from a specified table in the database based on given conditions.
@@ -0,0 +1,291 @@
+#!/home/michael/.pyenv/shims/python
+# rule_stats.py
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from dataclasses import dataclass
+from typing import Optional
+
+from psconnect import get_db_connection, validate_schema, select_recent, Connection
+from rules import Rule, Row, match_rule, fetch_rules, validate_rules
+
+# Average cost of a single rule evaluation before the rule is flagged
+RULE_BUDGET_MS = float(os.getenv("RULE_BUDGET_MS", "0.5"))
+# Cost of all of a user's rules against one message before the user is flagged
+USER_BUDGET_MS = float(os.getenv("USER_BUDGET_MS", "2.0"))
+# Seconds between budget checks and rule_stats flushes
+RULE_REPORT_INTERVAL = float(os.getenv("RULE_REPORT_INTERVAL", "300"))
+
+# rule_stats rows with this index hold the per-message total for a user
+USER_ROW_INDEX = -1
+
+# Adds a flush's counters to the stored totals, so every parser node contributes to the same rows.
+# A row whose rule text changed restarts from the new counters. Assignments run left to right,
+# so `rule` is updated last and avg_ms/over_budget see the new totals.
+ACCUMULATE_SQL = """
+INSERT INTO rule_stats (`user`, rule_index, `rule`, evaluations, matches, total_ms, avg_ms, over_budget)
+VALUES (%(user)s, %(rule_index)s, %(rule)s, %(evaluations)s, %(matches)s, %(total_ms)s, %(avg_ms)s, %(over_budget)s)
+ON DUPLICATE KEY UPDATE
+  evaluations = IF(`rule` <=> VALUES(`rule`), evaluations + VALUES(evaluations), VALUES(evaluations)),
+  matches = IF(`rule` <=> VALUES(`rule`), matches + VALUES(matches), VALUES(matches)),
+  total_ms = IF(`rule` <=> VALUES(`rule`), total_ms + VALUES(total_ms), VALUES(total_ms)),
+  avg_ms = IF(evaluations > 0, total_ms / evaluations, 0),
+  over_budget = avg_ms > IF(rule_index = {user_row_index}, {user_budget_ms}, {rule_budget_ms}),
+  `rule` = VALUES(`rule`)
+"""
+
+
+@dataclass
+class RuleCost:
+    source: Optional[Rule] = None
+    evaluations: int = 0
+    matches: int = 0
+    total_s: float = 0.0
+
+    @property
+    def rule(self) -> Optional[str]:
+        return json.dumps(self.source, sort_keys=True) if self.source is not None else None
+
+    @property
+    def avg_ms(self) -> float:
+        return 1000 * self.total_s / self.evaluations if self.evaluations else 0.0
+
+    @property
+    def match_rate(self) -> float:
+        return self.matches / self.evaluations if self.evaluations else 0.0
+
+
+class RuleStats:
+    """
+    Accumulates evaluation counts, time and matches per user and per rule.
+    Counters cover the time since the last flush; flush adds them to the totals in rule_stats.
+    """
+
+    def __init__(self, rule_budget_ms: float = RULE_BUDGET_MS, user_budget_ms: float = USER_BUDGET_MS) -> None:
+        self.rule_budget_ms = rule_budget_ms
+        self.user_budget_ms = user_budget_ms
+        self.rules: dict[tuple[str, int], RuleCost] = {}
+        self.users: dict[str, RuleCost] = {}
+        self.last_report = time.monotonic()
+
+    def record(self, user: str, index: int, rule: Rule, elapsed: float, matches: int, count: int = 1) -> None:
+        """
+        Records `count` evaluations of a user's rule taking `elapsed` seconds in total.
+        Counters restart when the rule at that index changes.
+        """
+        cost = self.rules.get((user, index))
+        if cost is None or cost.source is not rule:
+            if cost is not None and cost.source == rule:
+                # Same rule reloaded as a new dict; keep the identity check cheap from now on
+                cost.source = rule
+            else:
+                cost = self.rules[(user, index)] = RuleCost(source=rule)
+        cost.evaluations += count
+        cost.matches += int(matches)
+        cost.total_s += elapsed
+
+    def record_message(self, user: str, elapsed: float, matches: int, count: int = 1) -> None:
+        """
+        Records the time spent on all of a user's rules for `count` messages.
+        """
+        cost = self.users.setdefault(user, RuleCost())
+        cost.evaluations += count
+        cost.matches += int(matches)
+        cost.total_s += elapsed
+
+    def prune(self, conn: Connection, user_rules: dict[str, list[Rule]]) -> None:
+        """
+        Drops counters for removed users and rule indexes past the end of each user's
+        current list, and deletes the matching rule_stats rows.
+        """
+        self.users = {user: cost for user, cost in self.users.items() if user in user_rules}
+        self.rules = {
+            (user, index): cost for (user, index), cost in self.rules.items()
+            if user in user_rules and index < len(user_rules[user])
+        }
+        try:
+            with conn.cursor() as cursor:
+                if user_rules:
+                    placeholders = ", ".join(["%s"] * len(user_rules))
+                    cursor.execute(f"DELETE FROM rule_stats WHERE `user` NOT IN ({placeholders})", list(user_rules))
+                else:
+                    cursor.execute("DELETE FROM rule_stats")
+                cursor.executemany(
+                    "DELETE FROM rule_stats WHERE `user` = %s AND rule_index >= %s",
+                    [(user, len(rules)) for user, rules in user_rules.items()]
+                )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Failed to prune rule_stats: {e}")
+
+    def over_budget(self) -> list[tuple[str, int, RuleCost]]:
+        """
+        Returns (user, rule index, cost) for every user or rule above its budget.
+        User totals use USER_ROW_INDEX as their index.
+        """
+        flagged = [
+            (user, USER_ROW_INDEX, cost) for user, cost in self.users.items()
+            if cost.avg_ms > self.user_budget_ms
+        ]
+        flagged.extend(
+            (user, index, cost) for (user, index), cost in self.rules.items()
+            if cost.avg_ms > self.rule_budget_ms
+        )
+        return flagged
+
+    def report_rows(self) -> list[dict]:
+        """
+        Returns rule_stats table rows for every tracked user and rule.
+        """
+        rows = []
+        entries = [((user, USER_ROW_INDEX), cost, self.user_budget_ms) for user, cost in self.users.items()]
+        entries.extend((key, cost, self.rule_budget_ms) for key, cost in self.rules.items())
+        for (user, index), cost, budget in entries:
+            rows.append({
+                "user": user,
+                "rule_index": index,
+                "rule": cost.rule,
+                "evaluations": cost.evaluations,
+                "matches": cost.matches,
+                "total_ms": round(1000 * cost.total_s, 3),
+                "avg_ms": round(cost.avg_ms, 6),
+                "over_budget": int(cost.avg_ms > budget)
+            })
+        return rows
+
+    def flush(self, conn: Connection) -> None:
+        """
+        Logs users and rules over budget since the last flush, adds the counters to rule_stats
+        and resets them. Counters are kept for the next flush if the write fails.
+        """
+        for user, index, cost in self.over_budget():
+            if index == USER_ROW_INDEX:
+                logging.warning(f"User {user} over budget: {cost.avg_ms:.3f} ms per message "
+                                f"(budget {self.user_budget_ms} ms, {cost.evaluations} messages)")
+            else:
+                logging.warning(f"Rule {index} of {user} over budget: {cost.avg_ms:.3f} ms per evaluation "
+                                f"(budget {self.rule_budget_ms} ms, match rate {cost.match_rate:.2%}): {cost.rule}")
+        rows = [row for row in self.report_rows() if row["evaluations"] and validate_schema(row, "rule_stats")]
+        sql = ACCUMULATE_SQL.format(user_row_index=USER_ROW_INDEX, user_budget_ms=float(self.user_budget_ms),
+                                    rule_budget_ms=float(self.rule_budget_ms))
+        self.last_report = time.monotonic()
+        try:
+            with conn.cursor() as cursor:
+                cursor.executemany(sql, rows)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Failed to write rule_stats: {e}")
+            return
+        for cost in list(self.users.values()) + list(self.rules.values()):
+            cost.evaluations = 0
+            cost.matches = 0
+            cost.total_s = 0.0
+
+    def maybe_flush(self, conn: Connection) -> None:
+        """
+        Flushes if RULE_REPORT_INTERVAL has passed since the last flush.
+        """
+        if time.monotonic() - self.last_report >= RULE_REPORT_INTERVAL:
+            self.flush(conn)
+
+
+def estimate_cost(rules: list[Rule], logs: list[Row]) -> RuleStats:
+    """
+    Replays logs against a rule list the same way parse_log does and returns the measured costs.
+    """
+    stats = RuleStats()
+    for log in logs:
+        if log["type"] not in ["msg", "action"]:
+            continue
+        user_elapsed = 0.0
+        user_matched = False
+        for index, rule in enumerate(rules):
+            start = time.perf_counter()
+            matched = match_rule(rule, log)
+            elapsed = time.perf_counter() - start
+            stats.record("dry-run", index, rule, elapsed, matched)
+            user_elapsed += elapsed
+            user_matched = user_matched or matched
+        stats.record_message("dry-run", user_elapsed, user_matched)
+    return stats
+
+
+def print_estimate(label: str, stats: RuleStats) -> None:
+    """
+    Prints a per-rule and per-message cost table for a dry run.
+    """
+    total = stats.users.get("dry-run", RuleCost())
+    print(f"{label}: {total.avg_ms:.4f} ms per message over {total.evaluations} messages, "
+          f"match rate {total.match_rate:.2%} (budget {stats.user_budget_ms} ms)")
+    for (_, index), cost in sorted(stats.rules.items()):
+        flag = "  OVER BUDGET" if cost.avg_ms > stats.rule_budget_ms else ""
+        print(f"  [{index}] {cost.avg_ms:.4f} ms  match {cost.match_rate:6.2%}  {cost.rule}{flag}")
+
+
+def dry_run(conn: Connection, nickname: str, hotwords_path: str, sample: int) -> int:
+    """
+    Estimates the per-message cost of a proposed hotwords list against recent logs.
+    """
+    with (sys.stdin if hotwords_path == "-" else open(hotwords_path)) as f:
+        proposed = json.load(f)
+    if not isinstance(proposed, list) or not validate_rules(proposed):
+        print("Proposed hotwords are not a valid list of rules", file=sys.stderr)
+        return 1
+
+    logs = select_recent(conn, "logs", sample) or []
+    print(f"Replaying {len(logs)} recent logs")
+    print_estimate("current", estimate_cost(fetch_rules(conn, nickname), logs))
+    proposed_stats = estimate_cost(proposed, logs)
+    print_estimate("proposed", proposed_stats)
+    return 1 if proposed_stats.over_budget() else 0
+
+
+def print_report(conn: Connection, only_flagged: bool) -> None:
+    """
+    Prints the rule_stats table, most expensive first.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT * FROM rule_stats"
+            + (" WHERE over_budget = 1" if only_flagged else "")
+            + " ORDER BY total_ms DESC"
+        )
+        for row in cursor.fetchall():
+            target = "all rules" if row["rule_index"] == USER_ROW_INDEX else f"rule {row['rule_index']}"
+            flag = "  OVER BUDGET" if row["over_budget"] else ""
+            print(f"{row['user']:<16} {target:<10} {row['evaluations']:>10} evals  "
+                  f"{row['total_ms']:>12.1f} ms  {row['avg_ms']:.4f} ms avg  "
+                  f"{row['matches']:>8} matches{flag}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Hotword rule cost tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    report = commands.add_parser("report", help="show rule_stats written by parse_logs")
+    report.add_argument("--flagged", action="store_true", help="only users and rules over budget")
+
+    dry = commands.add_parser("dry-run", help="estimate the cost of a proposed hotwords list")
+    dry.add_argument("nickname")
+    dry.add_argument("hotwords", help="JSON file with the proposed rule list, or - for stdin")
+    dry.add_argument("--sample", type=int, default=5000, help="number of recent logs to replay")
+
+    args = parser.parse_args()
+    conn = get_db_connection()
+    try:
+        if args.command == "report":
+            print_report(conn, args.flagged)
+        else:
+            sys.exit(dry_run(conn, args.nickname, args.hotwords, args.sample))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+#!/home/michael/.pyenv/shims/python
+# soak.py
+
+import os
+import sys
+import csv
+import json
+import time
+import signal
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+from typing import Optional
+
+from psconnect import get_db_connection, Connection
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+SOAK_USER = "soak"
+SOAK_WORD = "soakhit"
+
+# Tables the daemons need that are not part of zlog_schema.sql
+EXTRA_TABLES = [
+    """CREATE TABLE IF NOT EXISTS `logs_id_track` (
+      `id` INT NOT NULL,
+      `tid` INT DEFAULT NULL,
+      PRIMARY KEY (`id`)
+    )""",
+    "CREATE TABLE IF NOT EXISTS `pm_table` LIKE `logs_queue`",
+]
+RESET_TABLES = ("logs", "logs_queue", "push", "event_log", "logs_id_track", "rule_stats", "leases")
+
+
+def setup_database(conn: Connection, reset: bool) -> None:
+    """
+    Creates any missing tables, optionally empties them, and installs the soak user's rules.
+    """
+    with open(os.path.join(ROOT, "zlog_schema.sql")) as f:
+        statements = [s.strip() for s in f.read().split(";") if s.strip()]
+    with conn.cursor() as cursor:
+        for statement in statements + EXTRA_TABLES:
+            cursor.execute(statement.replace("CREATE TABLE `", "CREATE TABLE IF NOT EXISTS `"))
+        if reset:
+            for table in RESET_TABLES:
+                cursor.execute(f"TRUNCATE TABLE `{table}`")
+        cursor.execute(
+            "REPLACE INTO users (nickname, hotwords) VALUES (%s, %s)",
+            (SOAK_USER, json.dumps([{"type": "substring", "match": SOAK_WORD}]))
+        )
+
+
+def seed_tracker(conn: Connection) -> int:
+    """
+    Points logs_id_track at the current end of logs so the daemons start from fresh rows.
+    Returns the id the injector should start after.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT MAX(id) AS max_id FROM logs")
+        start = max((cursor.fetchone() or {}).get("max_id") or 0, 28000000)
+        cursor.execute("REPLACE INTO logs_id_track (id, tid) VALUES (1, %s)", (start,))
+    return start
+
+
+class Recorder:
+    """
+    Per-row timestamps shared by the injector and the watcher threads.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.injected: dict[int, float] = {}
+        self.delivered: dict[int, float] = {}
+        self.expected: set[int] = set()
+        self.pending: set[int] = set()
+        self.latencies: list[float] = []
+        self.window_latencies: list[float] = []
+        self.injected_count = 0
+
+    def inject(self, ids: list[int], matching: list[int], at: float) -> None:
+        with self.lock:
+            for row_id in ids:
+                self.injected[row_id] = at
+            self.expected.update(matching)
+            self.pending.update(matching)
+            self.injected_count += len(ids)
+
+    def deliver(self, first_id: int, last_id: int, at: float) -> None:
+        with self.lock:
+            for row_id in range(first_id, last_id + 1):
+                if row_id in self.pending:
+                    self.pending.discard(row_id)
+                    self.delivered[row_id] = at
+                    latency = at - self.injected[row_id]
+                    self.latencies.append(latency)
+                    self.window_latencies.append(latency)
+
+    def low_watermark(self, default: int) -> int:
+        """
+        Highest id below which every expected row has been delivered.
+        """
+        with self.lock:
+            return min(self.pending) - 1 if self.pending else max(self.injected, default=default)
+
+    def take_window(self) -> list[float]:
+        with self.lock:
+            window, self.window_latencies = self.window_latencies, []
+        return window
+
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "no deliveries"
+    values = sorted(values)
+
+    def pick(p: float) -> float:
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return (f"p50 {1000 * pick(0.50):.0f} ms  p90 {1000 * pick(0.90):.0f} ms  "
+            f"p99 {1000 * pick(0.99):.0f} ms  max {1000 * values[-1]:.0f} ms")
+
+
+def current_rate(args: argparse.Namespace, elapsed: float) -> float:
+    """
+    Injection rate at a point in the run: the base rate, or the burst rate during a burst.
+    """
+    if args.burst_every and elapsed % args.burst_every < args.burst_length:
+        return args.burst_rate
+    return args.rate
+
+
+def inject(args: argparse.Namespace, recorder: Recorder, start_id: int, stop: threading.Event) -> None:
+    """
+    Inserts synthetic log rows with explicit ids at the configured rate.
+    """
+    conn = get_db_connection()
+    next_id = start_id + 1
+    started = last = time.monotonic()
+    owed = 0.0
+    tick = 0.05
+    try:
+        while not stop.is_set():
+            # Rows owed for the real time since the last pass, so slow inserts do not lower the rate
+            now_mono = time.monotonic()
+            owed += current_rate(args, now_mono - started) * (now_mono - last)
+            last = now_mono
+            n = int(owed)
+            owed -= n
+            if n:
+                rows = []
+                matching = []
+                now = datetime.now()
+                for row_id in range(next_id, next_id + n):
+                    hit = (row_id % 1000) < args.match_ratio * 1000
+                    if hit:
+                        matching.append(row_id)
+                    channel = row_id % args.channels
+                    # Several networks, so traffic spreads over every partition in multi-node runs
+                    network = f"soaknet{row_id % args.networks}"
+                    rows.append((row_id, now, "soak", network, f"#soak{channel}", "msg", f"soaker{channel}",
+                                 f"{SOAK_WORD if hit else 'chatter'} {row_id} " + "x" * args.message_size))
+                next_id += n
+                with conn.cursor() as cursor:
+                    cursor.executemany(
+                        "INSERT INTO logs (id, created_at, user, network, `window`, type, nick, message) "
+                        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", rows
+                    )
+                recorder.inject([row[0] for row in rows], matching, time.time())
+            stop.wait(tick)
+    finally:
+        conn.close()
+
+
+def watch(recorder: Recorder, start_id: int, stop: threading.Event, interval: float) -> None:
+    """
+    Polls push for new rows and records when each injected row was delivered.
+    Digest rows deliver every id between first_id and last_id. Polling restarts from the
+    oldest undelivered row because several parser nodes may write pushes out of id order.
+    """
+    conn = get_db_connection()
+    try:
+        while not stop.is_set():
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT id, first_id, last_id FROM push WHERE id > %s AND recipient = %s ORDER BY id",
+                    (recorder.low_watermark(start_id), SOAK_USER)
+                )
+                rows = cursor.fetchall()
+            now = time.time()
+            for row in rows:
+                recorder.deliver(row["first_id"] or row["id"], row["last_id"] or row["id"], now)
+            stop.wait(interval)
+    finally:
+        conn.close()
+
+
+def start_daemons(topology: str, work_dir: str, nodes: int, partitions: int) -> list[subprocess.Popen]:
+    """
+    Starts the daemons in their own process groups, logging into work_dir.
+    With partitions set, `nodes` copies of each daemon run in lease-coordinated mode.
+    """
+    env = dict(os.environ)
+    if partitions:
+        env["PARTITIONS"] = str(partitions)
+    if topology == "main":
+        commands = [["bash", os.path.join(ROOT, "main.sh")]] * nodes
+    else:
+        commands = [[sys.executable, os.path.join(ROOT, name)] for name in ("zlog_queue.py", "parse_logs.py")] * nodes
+    # Each node runs one main.sh, or a zlog_queue/parse_logs pair
+    per_node = 1 if topology == "main" else 2
+    procs = []
+    for i, command in enumerate(commands):
+        node_dir = os.path.join(work_dir, f"node{i // per_node}") if nodes > 1 else work_dir
+        os.makedirs(node_dir, exist_ok=True)
+        out = open(os.path.join(node_dir, f"{os.path.basename(command[-1])}.out"), "w")
+        procs.append(subprocess.Popen(command, cwd=ROOT if topology == "main" else node_dir, env=env,
+                                      stdout=out, stderr=subprocess.STDOUT, start_new_session=True))
+    return procs
+
+
+def rss_by_process(pgids: set[int]) -> dict[str, int]:
+    """
+    Returns resident memory in KiB for every process in the given process groups (Linux only).
+    """
+    usage: dict[str, int] = {}
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+            if int(stat.rsplit(")", 1)[1].split()[2]) not in pgids:
+                continue
+            with open(f"/proc/{pid}/cmdline") as f:
+                name = os.path.basename(f.read().split("\0")[-2] or pid)
+            with open(f"/proc/{pid}/status") as f:
+                rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+            usage[f"{name}[{pid}]"] = rss
+        except (OSError, IndexError, ValueError, StopIteration):
+            continue
+    return usage
+
+
+def run(args: argparse.Namespace) -> None:
+    conn = get_db_connection()
+    setup_database(conn, args.reset)
+    start_id = seed_tracker(conn)
+    conn.close()
+
+    work_dir = os.path.abspath(args.work_dir or f"soak-{time.strftime('%Y%m%d-%H%M%S')}")
+    os.makedirs(work_dir, exist_ok=True)
+    procs = start_daemons(args.topology, work_dir, args.nodes, args.partitions)
+    pgids = {proc.pid for proc in procs}
+
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=inject, args=(args, recorder, start_id, stop), daemon=True),
+        threading.Thread(target=watch, args=(recorder, start_id, stop, args.poll), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    started = time.monotonic()
+    baseline_rss: Optional[dict[str, int]] = None
+    last_injected = 0
+    last_delivered = 0
+    print(f"Soak run: {args.topology} topology, logs in {work_dir}")
+    try:
+        while time.monotonic() - started < args.duration:
+            time.sleep(args.report_interval)
+            if any(proc.poll() is not None for proc in procs):
+                print("A daemon exited, stopping the run")
+                break
+            rss = rss_by_process(pgids)
+            baseline_rss = baseline_rss or rss
+            injected, delivered = recorder.injected_count, len(recorder.delivered)
+            growth = sum(rss.values()) - sum(baseline_rss.values())
+            print(f"[{time.monotonic() - started:8.0f}s] injected {(injected - last_injected) / args.report_interval:7.1f}/s  "
+                  f"delivered {(delivered - last_delivered) / args.report_interval:7.1f}/s  "
+                  f"backlog {len(recorder.pending)}  {percentiles(recorder.take_window())}  "
+                  f"rss {sum(rss.values()) // 1024} MiB ({growth:+d} KiB)")
+            last_injected, last_delivered = injected, delivered
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        for proc in procs:
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGTERM)
+        for proc in procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                print(f"Daemon {proc.pid} did not stop, killing it")
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+
+    elapsed = time.monotonic() - started
+    print(f"\nInjected {recorder.injected_count} rows in {elapsed:.0f}s "
+          f"({recorder.injected_count / elapsed:.1f}/s), delivered {len(recorder.delivered)} "
+          f"of {len(recorder.expected)} expected pushes ({len(recorder.delivered) / elapsed:.1f}/s)")
+    print(f"Latency: {percentiles(recorder.latencies)}")
+
+    with open(os.path.join(work_dir, "rows.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "injected_at", "delivered_at", "latency_ms"])
+        for row_id in sorted(recorder.injected):
+            delivered_at = recorder.delivered.get(row_id)
+            latency = f"{1000 * (delivered_at - recorder.injected[row_id]):.1f}" if delivered_at else ""
+            writer.writerow([row_id, f"{recorder.injected[row_id]:.3f}",
+                             f"{delivered_at:.3f}" if delivered_at else "", latency])
+    print(f"Per-row timestamps written to {os.path.join(work_dir, 'rows.csv')}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end latency soak test against a local database")
+    parser.add_argument("--topology", choices=("daemons", "main"), default="daemons",
+                        help="run both daemons directly, or through main.sh")
+    parser.add_argument("--duration", type=float, default=3600, help="seconds to run")
+    parser.add_argument("--rate", type=float, default=20, help="rows per second between bursts")
+    parser.add_argument("--burst-rate", type=float, default=200, help="rows per second during bursts")
+    parser.add_argument("--burst-every", type=float, default=300, help="seconds between burst starts, 0 disables")
+    parser.add_argument("--burst-length", type=float, default=30, help="seconds each burst lasts")
+    parser.add_argument("--match-ratio", type=float, default=0.1, help="fraction of rows matching the soak rule")
+    parser.add_argument("--channels", type=int, default=10, help="number of synthetic channels")
+    parser.add_argument("--networks", type=int, default=64,
+                        help="number of synthetic networks, which decide the partition of each row")
+    parser.add_argument("--message-size", type=int, default=80, help="filler characters per message")
+    parser.add_argument("--poll", type=float, default=0.1, help="seconds between push polls")
+    parser.add_argument("--report-interval", type=float, default=60, help="seconds between progress lines")
+    parser.add_argument("--nodes", type=int, default=1, help="copies of each daemon to run")
+    parser.add_argument("--partitions", type=int, default=0,
+                        help="run the daemons with PARTITIONS set, required for more than one node")
+    parser.add_argument("--work-dir", help="directory for daemon logs and rows.csv")
+    parser.add_argument("--reset", action="store_true", help="empty the log, queue and output tables first")
+    parser.add_argument("--allow-remote", action="store_true", help="allow a DB_HOST that is not local")
+    args = parser.parse_args()
+
+    if os.getenv("DB_HOST") not in LOCAL_HOSTS and not args.allow_remote:
+        parser.error(f"DB_HOST={os.getenv('DB_HOST')} is not local; the soak test writes synthetic rows "
+                     "and a 'soak' user, pass --allow-remote to run it anyway")
+    if args.nodes > 1 and not args.partitions:
+        parser.error("--nodes above 1 needs --partitions, otherwise the nodes duplicate each other's work")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
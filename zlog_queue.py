@@ -1,12 +1,18 @@
 #!/home/michael/.pyenv/shims/python
 # zlog_queue.py
 
+import os
 import time
 from typing import Optional
-from psconnect import get_db_connection, insert_into, replace_into, select_from, Connection
+from psconnect import get_db_connection, insert_many, replace_into, select_from, Connection
+from profiler import install_profiler
+from leases import LeaseManager, PARTITIONS, QUEUE_LEASE, network_partition
 import logging
 from logging.handlers import RotatingFileHandler
 
+# Rows copied per page; the queue lease is renewed between pages
+QUEUE_PAGE_SIZE = int(os.getenv("QUEUE_PAGE_SIZE", "1000"))
+
 def setup_logging() -> logging.Logger:
     """
     Sets up logging for the application, creating handlers for different log levels and adding them to the logger.
@@ -49,28 +55,37 @@ def mark_as_processed(conn: Connection, last_id: Optional[int]) -> None:
         replace_into(conn, {'id': 1, 'tid': last_id}, table="logs_id_track")
 
 
-def copy_new_logs(conn: Connection, logger: logging.Logger) -> int:
+def copy_new_logs(conn: Connection, logger: logging.Logger, leases: Optional[LeaseManager] = None) -> int:
     """
     Copies new log entries from the 'logs' table to the 'logs_queue' table and marks them as processed.
+    Rows are copied in pages of QUEUE_PAGE_SIZE. With leases, the queue lease is renewed between
+    pages and copying stops as soon as it is lost, so a standby node never copies alongside us.
     """
     # Initialize or retrieve the last processed/copied ID
     last_copied_id = get_last_processed_id(conn) or 28000000
 
     try:
-        # Select new log entries that haven't been processed/copied yet
-        new_logs = select_from(conn, "logs", last_copied_id)
-
-        # Copy the new logs into another table or process them as needed
-        if new_logs:
+        while True:
+            if leases is not None and leases.renew_due() and QUEUE_LEASE not in leases.renew([QUEUE_LEASE]):
+                logger.warning("Lost the queue lease while copying, standing by")
+                break
+            # Select the next page of log entries that haven't been processed/copied yet
+            new_logs = select_from(conn, "logs", last_copied_id, limit=QUEUE_PAGE_SIZE)
+            if not new_logs:
+                break
             for log in new_logs:
-                try:
-                    insert_into(conn, log, table="logs_queue")
-                    highest_id_in_batch = log['id']
-                    mark_as_processed(conn, highest_id_in_batch)
-                    last_copied_id = highest_id_in_batch
-                except Exception as e:
-                    logger.error(f"An error occurred while copying log {log['id']}: {e}")
-                    raise e
+                log['partition'] = network_partition(log['network'], PARTITIONS)
+            try:
+                # Rows already queued before a crash between the insert and the tracker update are skipped
+                insert_many(conn, new_logs, table="logs_queue", ignore=True)
+                highest_id_in_batch = new_logs[-1]['id']
+                mark_as_processed(conn, highest_id_in_batch)
+                last_copied_id = highest_id_in_batch
+            except Exception as e:
+                logger.error(f"An error occurred while copying logs {new_logs[0]['id']}..{new_logs[-1]['id']}: {e}")
+                raise e
+            if len(new_logs) < QUEUE_PAGE_SIZE:
+                break
     except Exception as e:
         logger.error(f"An error occurred while copying logs: {e}")
         raise e
@@ -83,10 +98,19 @@ def main() -> None:
     Main function that sets up logging, copies new logs, and marks them as processed in a loop.
     """
     logger = setup_logging()
+    install_profiler("zlog_queue")
     try:
         conn = get_db_connection()
+        # With several queue nodes only the holder of the queue lease copies; the rest stand by
+        leases = LeaseManager(conn) if PARTITIONS else None
+        if leases is not None:
+            leases.ensure([QUEUE_LEASE])
         while True:
-            last_copied_id = copy_new_logs(conn, logger)
+            if leases is not None and not leases.hold(QUEUE_LEASE):
+                logger.debug("Standing by, queue lease held by another node")
+                time.sleep(1)
+                continue
+            last_copied_id = copy_new_logs(conn, logger, leases)
             logger.debug(f"Last copied ID: {last_copied_id}")
             time.sleep(1)  # Adjust the sleep time as necessary
     except Exception as e:
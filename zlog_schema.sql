@@ -72,6 +72,7 @@ CREATE TABLE `logs_queue` (
   `type` VARCHAR(32) NOT NULL,
   `nick` VARCHAR(128) DEFAULT NULL,
   `message` TEXT,
+  `partition` INT NOT NULL DEFAULT 0,
   PRIMARY KEY (`id`),
   KEY `created_at` (`created_at`),
   KEY `user` (`user`),
@@ -79,7 +80,8 @@ CREATE TABLE `logs_queue` (
   KEY `nick_idx` (`nick`),
   KEY `window_idx` (`window`),
   KEY `window_nick_idx` (`window`,`nick`),
-  KEY `type_idx` (`type`)
+  KEY `type_idx` (`type`),
+  KEY `partition_id_idx` (`partition`,`id`)
 );
 
 CREATE TABLE `push` (
@@ -90,8 +92,11 @@ CREATE TABLE `push` (
   `type` VARCHAR(32) NOT NULL,
   `nick` VARCHAR(128) DEFAULT NULL,
   `message` TEXT,
-  `recipient` VARCHAR(64) DEFAULT 'self',
-  PRIMARY KEY (`id`),
+  `recipient` VARCHAR(64) NOT NULL DEFAULT 'self',
+  `match_count` INT NOT NULL DEFAULT 1,
+  `first_id` INT DEFAULT NULL,
+  `last_id` INT DEFAULT NULL,
+  PRIMARY KEY (`id`, `recipient`),
   KEY `user` (`user`)
 );
 
@@ -101,3 +106,25 @@ CREATE TABLE `users` (
   `hotwords` JSON DEFAULT NULL,
   PRIMARY KEY (`nickname`)
 );
+
+CREATE TABLE `rule_stats` (
+  `user` VARCHAR(64) NOT NULL,
+  `rule_index` INT NOT NULL,
+  `rule` TEXT,
+  `evaluations` BIGINT NOT NULL,
+  `matches` BIGINT NOT NULL,
+  `total_ms` DOUBLE NOT NULL,
+  `avg_ms` DOUBLE NOT NULL,
+  `over_budget` TINYINT NOT NULL DEFAULT 0,
+  `updated_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`user`, `rule_index`),
+  KEY `over_budget_idx` (`over_budget`)
+);
+
+CREATE TABLE `leases` (
+  `name` VARCHAR(64) NOT NULL,
+  `owner` VARCHAR(128) DEFAULT NULL,
+  `expires_at` DATETIME(3) DEFAULT NULL,
+  `heartbeat_at` DATETIME(3) DEFAULT NULL,
+  PRIMARY KEY (`name`)
+);